@@ -10,169 +10,340 @@ Usage:
     latex = to_latex(egglog_rule_string)
 """
 
+import io
 import re
-from typing import Tuple, List, Optional
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, Iterable, Tuple, List, Optional, Union
+
+
+LPAREN, RPAREN, ATOM = 0, 1, 2
+
+# Token kinds, token text and matching-paren indices, as built by _tokenize
+Tokens = Tuple[List[int], List[str], List[int]]
+
+_TOKEN_RE = re.compile(r'[()]|[^\s()]+')
+_RULE_START_RE = re.compile(r'\((rule|rewrite)\s')
+# Function-call heads: word characters and '-', with at least one alphanumeric
+_FN_RE = re.compile(r'[_-]*[^\W_][\w-]*\Z')
+
+# Characters that must be escaped inside \text{...}
+_TEXT_ESCAPES = str.maketrans({
+    '_': '\\_',
+    '%': '\\%',
+    '&': '\\&',
+    '#': '\\#',
+    '$': '\\$',
+    '{': '\\{',
+    '}': '\\}',
+    '^': '\\^{}',
+    '~': '\\~{}',
+    '\\': '\\textbackslash{}',
+})
+
+# Formatted form of identifiers seen so far, filled by format_identifier and
+# cleared once it reaches _IDENTIFIERS_MAXSIZE entries
+_IDENTIFIERS: Dict[str, str] = {}
+_IDENTIFIERS_MAXSIZE = 4096
+
+# Cleaned form of expression spans keyed on their token text, filled by
+# _clean_tokens and cleared once it reaches _CLEANED_MAXSIZE entries
+_CLEANED: Dict[Tuple[str, ...], str] = {}
+_CLEANED_MAXSIZE = 4096
+
+
+def _py_tokenize(text: str) -> Tokens:
+    """
+    Split an s-expression into a flat token stream in a single pass.
 
+    Returns parallel lists of token kinds, token text and matching-paren
+    indices: match[i] is the index of the paren closing (or opening) token i,
+    and -1 for atoms. Stray ')' are dropped and unclosed '(' are closed at the
+    end, so the stream is always balanced.
 
-def clean_expression(expr: str) -> str:
-    """Clean and format an expression for LaTeX display."""
-    expr = expr.strip()
-
-    def format_identifier(word: str) -> str:
-        """Format a single identifier for LaTeX."""
-        if word.isdigit() or (len(word) == 1 and word.isalpha()):
-            return word
-        formatted = word.replace('_', '\\_')
-        return f"\\text{{{formatted}}}"
-
-    def parse_expression(text: str) -> str:
-        """Parse and format expressions recursively."""
-        text = text.strip()
-
-        # If no parentheses, just format identifiers
-        if not text.startswith('('):
-            words = text.split()
-            return ' '.join(format_identifier(word) for word in words)
-
-        # Remove outer parentheses and parse content
-        inner = text[1:-1].strip()
-        parts = []
-        current = ""
-        depth = 0
-
-        for char in inner:
-            if char == '(':
-                depth += 1
-            elif char == ')':
-                depth -= 1
-            elif char == ' ' and depth == 0:
-                if current.strip():
-                    parts.append(current.strip())
-                    current = ""
-                continue
-            current += char
-
-        if current.strip():
-            parts.append(current.strip())
+    egglog_to_inference_core.tokenize mirrors this function and must be
+    changed in lockstep with it; _core_matches checks this at import.
+    """
+    kinds: List[int] = []
+    atoms: List[str] = []
+    match: List[int] = []
+    stack: List[int] = []
+
+    for token in _TOKEN_RE.findall(text):
+        if token == '(':
+            stack.append(len(kinds))
+            kinds.append(LPAREN)
+            atoms.append(token)
+            match.append(-1)
+        elif token == ')':
+            if stack:
+                open_idx = stack.pop()
+                match[open_idx] = len(kinds)
+                kinds.append(RPAREN)
+                atoms.append(token)
+                match.append(open_idx)
+        else:
+            kinds.append(ATOM)
+            atoms.append(sys.intern(token))
+            match.append(-1)
+
+    while stack:
+        open_idx = stack.pop()
+        match[open_idx] = len(kinds)
+        kinds.append(RPAREN)
+        atoms.append(')')
+        match.append(open_idx)
+
+    return kinds, atoms, match
+
+
+def _items(kinds: List[int], match: List[int], lo: int, hi: int) -> List[int]:
+    """Return the start index of each top-level item in tokens[lo:hi]."""
+    starts = []
+    i = lo
+    while i < hi:
+        starts.append(i)
+        i = match[i] + 1 if kinds[i] == LPAREN else i + 1
+    return starts
+
+
+def _item_end(kinds: List[int], match: List[int], start: int) -> int:
+    """Return the index one past the item starting at start."""
+    return match[start] + 1 if kinds[start] == LPAREN else start + 1
+
+
+def _unparse(kinds: List[int], atoms: List[str], lo: int, hi: int) -> str:
+    """Render tokens[lo:hi] back to s-expression text."""
+    parts = []
+    prev = LPAREN
+    for i in range(lo, hi):
+        kind = kinds[i]
+        if parts and kind != RPAREN and prev != LPAREN:
+            parts.append(' ')
+        parts.append(atoms[i])
+        prev = kind
+    return ''.join(parts)
+
+
+def format_identifier(word: str) -> str:
+    """Format a single identifier for LaTeX."""
+    formatted = _IDENTIFIERS.get(word)
+    if formatted is None:
+        if len(_IDENTIFIERS) >= _IDENTIFIERS_MAXSIZE:
+            _IDENTIFIERS.clear()
+        formatted = _IDENTIFIERS[word] = _format_identifier(word)
+    return formatted
+
+
+def _format_identifier(word: str) -> str:
+    """Format an identifier that is not in the cache yet."""
+    if word.isdigit() or (len(word) == 1 and word.isalpha()):
+        return word
+    formatted = word.translate(_TEXT_ESCAPES)
+    return f"\\text{{{formatted}}}"
+
+
+def _py_parse_expression(kinds: List[int], atoms: List[str], match: List[int],
+                         lo: int, hi: int) -> str:
+    """
+    Parse and format tokens[lo:hi].
 
+    Nested lists are walked with an explicit work stack of token indices
+    and literal separators, appending fragments to a single output list
+    that is joined once at the end. Items outside any list are formatted
+    in turn and space-separated.
+
+    egglog_to_inference_core.format_tree mirrors this function and must be
+    changed in lockstep with it; _core_matches checks this at import.
+    """
+    identifiers = _IDENTIFIERS
+    out: List[str] = []
+    work: List[Union[int, str]] = []
+    for start in reversed(_items(kinds, match, lo, hi)):
+        if work:
+            work.append(' ')
+        work.append(start)
+
+    while work:
+        item = work.pop()
+        if isinstance(item, str):
+            out.append(item)
+            continue
+
+        if kinds[item] == ATOM:
+            word = atoms[item]
+            out.append(identifiers.get(word) or format_identifier(word))
+            continue
+
+        parts = _items(kinds, match, item + 1, match[item])
         if not parts:
-            return ""
+            continue
 
-        # Check if this is a set operation
-        if parts[0] == 'set' and len(parts) == 3:
+        # Children are pushed in reverse so they pop in output order
+        if len(parts) == 3 and atoms[item + 1] == 'set':
             # Format set(a, b) as a → b
-            lhs = parse_expression(parts[1])
-            rhs = parse_expression(parts[2])
-            return f"{lhs} \\to {rhs}"
+            work += (parts[2], ' \\to ', parts[1])
+        elif len(parts) == 1:
+            work += (')', parts[0], '(')
+        else:
+            # Format as function call
+            work.append(')')
+            for arg in reversed(parts[2:]):
+                work += (arg, ', ')
+            work += (parts[1], '(', parts[0])
+
+    return ''.join(out)
 
-        # Format as function call
-        func_name = format_identifier(parts[0])
-        if len(parts) == 1:
-            return f"({func_name})"
 
-        # Format arguments recursively
-        formatted_args = [parse_expression(arg) for arg in parts[1:]]
-        return f"{func_name}({', '.join(formatted_args)})"
+def clean_expression(expr: str) -> str:
+    """Clean and format an expression for LaTeX display."""
+    tokens = _tokenize(expr)
+    return _clean_tokens(tokens, 0, len(tokens[0]))
+
+
+def _clean_tokens(tokens: Tokens, lo: int, hi: int) -> str:
+    """
+    Clean and format the expression spanning tokens[lo:hi].
+
+    Results are cached on the span's token text, so a term repeated across
+    conditions, conclusions or rules is formatted once.
+    """
+    key = tuple(tokens[1][lo:hi])
+    cleaned = _CLEANED.get(key)
+    if cleaned is None:
+        if len(_CLEANED) >= _CLEANED_MAXSIZE:
+            _CLEANED.clear()
+        cleaned = _CLEANED[key] = _clean_span(tokens, lo, hi)
+    return cleaned
+
+
+def _clean_span(tokens: Tokens, lo: int, hi: int) -> str:
+    """Format a span that is not in the cache yet."""
+    kinds, atoms, match = tokens
+    if lo == hi:
+        return ""
 
     # Check if this is a function call
-    if expr.startswith('(') and expr.endswith(')'):
-        inner = expr[1:-1]
-        parts = inner.split()
-        if len(parts) > 1 and parts[0].replace('_', '').replace('-', '').isalnum():
+    if kinds[lo] == LPAREN and match[lo] == hi - 1:
+        parts = _items(kinds, match, lo + 1, hi - 1)
+        head = parts[0] if parts else None
+        if (len(parts) > 1 and kinds[head] == ATOM
+                and _FN_RE.match(atoms[head])):
             # This is a function call, parse it
-            return parse_expression(expr)
+            return _parse_expression(kinds, atoms, match, lo, hi)
         else:
             # Not a function call, remove outer parentheses
-            expr = inner
-
-    return parse_expression(expr)
+            lo, hi = lo + 1, hi - 1
+            if lo == hi:
+                return ""
+
+    return _parse_expression(kinds, atoms, match, lo, hi)
+
+
+def _find_closing(text: str, start: int) -> int:
+    """Return the index of the ')' matching the '(' at start, or -1."""
+    depth = 1
+    i = start + 1
+
+    # Jump between parens with str.find rather than stepping every character
+    while True:
+        close = text.find(')', i)
+        if close == -1:
+            return -1
+        opening = text.find('(', i, close)
+        if opening == -1:
+            depth -= 1
+            if depth == 0:
+                return close
+            i = close + 1
+        else:
+            depth += 1
+            i = opening + 1
 
 
 def extract_balanced_content(text: str, start: int = 0) -> Tuple[Optional[str], int]:
     """Extract balanced parentheses content starting from position."""
-    while start < len(text) and text[start] != '(':
-        start += 1
+    pos = text.find('(', start)
+    if pos == -1:
+        return None, max(start, len(text))
+
+    end = _find_closing(text, pos)
+    if end == -1:
+        return None, pos
+
+    # Trim by moving the span bounds so only one substring is allocated
+    lo, hi = pos + 1, end
+    while lo < hi and text[lo].isspace():
+        lo += 1
+    while hi > lo and text[hi - 1].isspace():
+        hi -= 1
+
+    return text[lo:hi], end + 1
+
+
+def _list_body(kinds: List[int], atoms: List[str], match: List[int],
+               head: str) -> List[int]:
+    """Return the body of a leading (head ...) form, else the top-level items."""
+    if len(kinds) > 2 and kinds[0] == LPAREN and atoms[1] == head and kinds[1] == ATOM:
+        return _items(kinds, match, 2, match[0])
+    return _items(kinds, match, 0, len(kinds))
+
+
+def _rule_sections(tokens: Tokens) -> Tuple[List[int], List[int]]:
+    """Return the start indices of a rule's conditions and conclusions."""
+    kinds, atoms, match = tokens
+
+    # Conditions and conclusions are the first two parenthesised groups
+    groups = [s for s in _list_body(kinds, atoms, match, 'rule')
+              if kinds[s] == LPAREN][:2]
+    sections = [_items(kinds, match, group + 1, match[group]) for group in groups]
+    while len(sections) < 2:
+        sections.append([])
 
-    if start >= len(text):
-        return None, start
+    return sections[0], sections[1]
 
-    paren_count = 0
-    content_start = start + 1
 
-    for i in range(start, len(text)):
-        if text[i] == '(':
-            paren_count += 1
-        elif text[i] == ')':
-            paren_count -= 1
-            if paren_count == 0:
-                return text[content_start:i].strip(), i + 1
+def _rewrite_terms(tokens: Tokens) -> List[int]:
+    """Return the start indices of a rewrite's terms, up to its first keyword."""
+    kinds, atoms, match = tokens
+    terms = []
 
-    return None, start
+    # Handle direct egglog format: (rewrite lhs rhs ...)
+    if len(kinds) > 2 and kinds[0] == LPAREN and atoms[1] == 'rewrite':
+        for s in _list_body(kinds, atoms, match, 'rewrite'):
+            if kinds[s] == ATOM and atoms[s].startswith(':'):
+                break
+            terms.append(s)
+
+    return terms
 
 
 def parse_rule(rule_text: str) -> Tuple[List[str], List[str]]:
     """Parse an egglog rule into conditions and conclusions."""
-    rule_text = rule_text.strip()
-    if rule_text.startswith('(rule'):
-        rule_text = rule_text[5:].strip()
-    if rule_text.endswith(')'):
-        rule_text = rule_text[:-1].strip()
-
-    # Extract conditions (first parentheses group)
-    conditions_content, pos = extract_balanced_content(rule_text, 0)
-    conclusions_content, _ = extract_balanced_content(rule_text, pos)
-
-    def parse_sexp_list(content: str) -> List[str]:
-        """Parse multiple s-expressions."""
-        if not content:
-            return []
-
-        expressions = []
-        pos = 0
-
-        while pos < len(content):
-            while pos < len(content) and content[pos].isspace():
-                pos += 1
-            if pos >= len(content):
-                break
+    tokens = _tokenize(rule_text)
+    kinds, atoms, match = tokens
+    condition_starts, conclusion_starts = _rule_sections(tokens)
 
-            if content[pos] == '(':
-                expr_content, new_pos = extract_balanced_content(content, pos)
-                if expr_content is not None:
-                    expressions.append(f"({expr_content})")
-                    pos = new_pos
-                else:
-                    pos += 1
-            else:
-                start = pos
-                while pos < len(content) and not content[pos].isspace() and content[pos] not in '()':
-                    pos += 1
-                if pos > start:
-                    expressions.append(content[start:pos])
-
-        return expressions
-
-    conditions = parse_sexp_list(conditions_content or "")
-    conclusions = parse_sexp_list(conclusions_content or "")
+    conditions = [_unparse(kinds, atoms, s, _item_end(kinds, match, s))
+                  for s in condition_starts]
+    conclusions = [_unparse(kinds, atoms, s, _item_end(kinds, match, s))
+                   for s in conclusion_starts]
 
     return conditions, conclusions
 
 
 def parse_rewrite(rule_text: str) -> Tuple[Optional[str], Optional[str]]:
     """Parse an egglog rewrite rule into LHS and RHS."""
-    rule_text = rule_text.strip()
+    tokens = _tokenize(rule_text)
+    kinds, atoms, match = tokens
+    terms = _rewrite_terms(tokens)
 
-    # Handle direct egglog format: (rewrite lhs rhs ...)
-    if rule_text.startswith('(rewrite'):
-        content = rule_text[8:].strip()
-        if content.endswith(')'):
-            content = content[:-1].strip()
-
-        lhs, pos = extract_balanced_content(content, 0)
-        rhs, _ = extract_balanced_content(content, pos)
-
-        if lhs and rhs:
-            return f"({lhs})", f"({rhs})"
+    if len(terms) >= 2:
+        lhs, rhs = terms[0], terms[1]
+        return (_unparse(kinds, atoms, lhs, _item_end(kinds, match, lhs)),
+                _unparse(kinds, atoms, rhs, _item_end(kinds, match, rhs)))
 
     return None, None
 
@@ -190,120 +361,220 @@ def format_multiline(items: List[str]) -> str:
 
 def clean_equation(expr: str) -> str:
     """Clean equation expressions, handling (= lhs rhs) format."""
-    expr = expr.strip()
-
-    if expr.startswith('(= '):
-        content = expr[3:]
-        if content.endswith(')'):
-            content = content[:-1]
-
-        # Split into lhs and rhs
-        parts = []
-        current = ""
-        paren_count = 0
-
-        for char in content:
-            if char == '(':
-                paren_count += 1
-            elif char == ')':
-                paren_count -= 1
-            elif char == ' ' and paren_count == 0 and current:
-                parts.append(current)
-                current = ""
-                continue
-            current += char
-
-        if current:
-            parts.append(current)
+    tokens = _tokenize(expr)
+    return _clean_equation_tokens(tokens, 0, len(tokens[0]))
+
 
+def _clean_equation_tokens(tokens: Tokens, lo: int, hi: int) -> str:
+    """Clean the equation or expression spanning tokens[lo:hi]."""
+    kinds, atoms, match = tokens
+
+    if (hi - lo > 2 and kinds[lo] == LPAREN and match[lo] == hi - 1
+            and atoms[lo + 1] == '=' and kinds[lo + 1] == ATOM):
+        # Split into lhs and the remaining rhs terms
+        parts = _items(kinds, match, lo + 2, hi - 1)
         if len(parts) >= 2:
-            lhs = clean_expression(parts[0])
-            rhs = clean_expression(' '.join(parts[1:]))
+            lhs = _clean_tokens(tokens, parts[0], parts[1])
+            rhs = _clean_tokens(tokens, parts[1], hi - 1)
             return f"{lhs} = {rhs}"
 
-    return clean_expression(expr)
+    return _clean_tokens(tokens, lo, hi)
 
 
-def to_latex(egglog_rule: str) -> str:
+def to_latex(egglog_rule: str, parallel: bool = False,
+             max_workers: Optional[int] = None) -> str:
     """
     Convert egglog rule(s) to LaTeX inference rule format.
 
     Args:
         egglog_rule: The egglog rule string or multiple rules
+        parallel: Convert multiple rules in a process pool. Under the spawn
+            start method the caller must be guarded by
+            ``if __name__ == '__main__'``.
+        max_workers: Number of worker processes when parallel is set
 
     Returns:
         LaTeX-formatted inference rule(s)
     """
     egglog_rule = egglog_rule.strip()
 
-    # Handle multiple rules
-    total_rules = egglog_rule.count('(rule') + egglog_rule.count('(rewrite')
-    if total_rules > 1:
-        # Extract and convert all rules
-        rules = []
-        pos = 0
-        text = egglog_rule
-
-        while pos < len(text):
-            while pos < len(text) and text[pos].isspace():
-                pos += 1
-            if pos >= len(text):
-                break
+    if parallel:
+        rule_texts = [rule_text for _, rule_text in _split_rules(egglog_rule)]
+        if len(rule_texts) > 1:
+            # Rules are independent; results computed in workers do not
+            # fill this process's per-rule cache
+            sink = io.StringIO()
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                _emit_rules(sink, executor.map(_to_latex, rule_texts, chunksize=8))
+            return sink.getvalue()
+
+    return _to_latex(egglog_rule)
+
+
+def _split_rules(text: str) -> List[Tuple[str, str]]:
+    """Return the (kind, text) of each top-level rule or rewrite in text."""
+    rules = []
+    end = 0
+    for rule_start in _RULE_START_RE.finditer(text):
+        start = rule_start.start()
+        if start < end:
+            # Nested inside the previous rule
+            continue
+
+        close = _find_closing(text, start)
+        if close == -1:
+            break
+        end = close + 1
+        rules.append((rule_start.group(1), text[start:end]))
 
-            if text[pos:pos+6] == '(rule ' or text[pos:pos+9] == '(rewrite ':
-                paren_count = 0
-                start = pos
-
-                while pos < len(text):
-                    if text[pos] == '(':
-                        paren_count += 1
-                    elif text[pos] == ')':
-                        paren_count -= 1
-                        if paren_count == 0:
-                            rules.append(text[start:pos+1])
-                            pos += 1
-                            break
-                    pos += 1
-            else:
-                pos += 1
-
-        if rules:
-            latex_rules = []
-            for i, rule in enumerate(rules, 1):
-                converted = to_latex(rule)
-                latex_rules.append(f"% Rule {i}\n{converted}")
-            return '\n\n'.join(latex_rules)
-
-    # Handle single rule
-    if egglog_rule.startswith('(rewrite'):
+    return rules
+
+
+@lru_cache(maxsize=1024)
+def _to_latex(egglog_rule: str) -> str:
+    """Cached body of to_latex, keyed on the stripped text."""
+    rules = _split_rules(egglog_rule)
+
+    # Handle multiple rules
+    if len(rules) > 1:
+        rule_texts = [rule_text for _, rule_text in rules]
+        # Each rule is cached on its own, so editing one rule in a
+        # large file only reconverts that rule
+        sink = io.StringIO()
+        _emit_rules(sink, map(_to_latex, rule_texts))
+        return sink.getvalue()
+
+    # Handle single rule, dispatching on the extracted span so that any
+    # declarations around it are skipped
+    if rules:
+        kind, rule_text = rules[0]
+        return _convert(kind, _tokenize(rule_text))
+
+    # No complete rule found; fall back to the head of the input
+    tokens = _tokenize(egglog_rule)
+    kinds, atoms, _ = tokens
+    kind = atoms[1] if len(kinds) > 1 and kinds[0] == LPAREN else None
+    return _convert(kind, tokens)
+
+
+def _emit_rules(sink: io.StringIO, converted: Iterable[str]) -> None:
+    """Write converted rules to sink as they arrive, each under a % Rule header."""
+    for i, rule_latex in enumerate(converted, 1):
+        if i > 1:
+            sink.write('\n\n')
+        sink.write(f"% Rule {i}\n")
+        sink.write(rule_latex)
+
+
+def _convert(kind: Optional[str], tokens: Tokens) -> str:
+    """Convert a single tokenized rule whose head is kind to LaTeX."""
+    kinds, _, match = tokens
+
+    if kind == 'rewrite':
         # Rewrite rule
-        lhs_expr, rhs_expr = parse_rewrite(egglog_rule)
-        if not lhs_expr or not rhs_expr:
+        terms = _rewrite_terms(tokens)
+        if len(terms) < 2:
             return "Error: Could not parse rewrite rule"
 
-        lhs_clean = clean_expression(lhs_expr)
-        rhs_clean = clean_expression(rhs_expr)
+        lhs, rhs = terms[0], terms[1]
+        lhs_clean = _clean_tokens(tokens, lhs, _item_end(kinds, match, lhs))
+        rhs_clean = _clean_tokens(tokens, rhs, _item_end(kinds, match, rhs))
 
         numerator = f"expr = {lhs_clean}"
         denominator = f"expr \\to {rhs_clean}"
-        return f"\\frac{{{numerator}}}{{{denominator}}}"
 
-    elif egglog_rule.startswith('(rule'):
+    elif kind == 'rule':
         # Regular rule
-        conditions, conclusions = parse_rule(egglog_rule)
+        conditions, conclusions = _rule_sections(tokens)
 
         if not conditions and not conclusions:
             return "Error: Could not parse rule"
 
         # Format conditions
-        condition_strs = [clean_equation(cond) for cond in conditions]
+        condition_strs = [_clean_equation_tokens(tokens, s, _item_end(kinds, match, s))
+                          for s in conditions]
         numerator = format_multiline(condition_strs)
 
         # Format conclusions
-        conclusion_strs = [clean_expression(concl) for concl in conclusions]
+        conclusion_strs = [_clean_tokens(tokens, s, _item_end(kinds, match, s))
+                           for s in conclusions]
         denominator = format_multiline(conclusion_strs)
 
-        return f"\\frac{{{numerator}}}{{{denominator}}}"
-
     else:
         return "Error: Unrecognized rule format"
+
+    return f"\\frac{{{numerator}}}{{{denominator}}}"
+
+
+# Inputs the compiled core is checked against at import: the notebook rules'
+# shapes plus set forms, empty lists, keywords and unbalanced parens
+_PARITY_SAMPLES = (
+    "(rule ((= ary2 (MatMul ary0 ary1)) (= (ArrayDesc_ndim ad0) 2)"
+    " (ArrayDesc_dim ad0 0)) ((ArrayDescOp ary2)"
+    " (set (ArrayDesc_ndim (ArrayDescOp ary2)) 2)) :ruleset r)",
+    "(rewrite (MatMul (MatMul ary0 ary1) ary2) (MatMul ary0 (MatMul ary1 ary2)))",
+    "(f () x) y (set a b c) (set (g) 1)",
+    "((f a) b)\n\t(% a_b (^ x\\y))",
+    "(f (g (h",
+    ")) x ) (",
+    "",
+)
+
+
+def _core_matches(core) -> bool:
+    """
+    Check a compiled core against the pure Python tokenizer and formatter.
+
+    Every sample is tokenized by both, and every list span in it, plus the
+    whole token stream, is formatted by both.
+    """
+    for text in _PARITY_SAMPLES:
+        tokens = _py_tokenize(text)
+        kinds, atoms, match = tokens
+        spans = [(0, len(kinds))] + [(i, match[i] + 1) for i in range(len(kinds))
+                                     if kinds[i] == LPAREN]
+        try:
+            if core.tokenize(text) != tokens:
+                return False
+            for lo, hi in spans:
+                if lo == hi:
+                    continue
+                compiled = core.format_tree(kinds, atoms, match, lo, hi,
+                                            _IDENTIFIERS, format_identifier)
+                if compiled != _py_parse_expression(kinds, atoms, match, lo, hi):
+                    return False
+        except Exception:
+            return False
+    return True
+
+
+def _core_parse_expression(kinds: List[int], atoms: List[str], match: List[int],
+                           lo: int, hi: int) -> str:
+    """Parse and format tokens[lo:hi] with the compiled core."""
+    return _core.format_tree(kinds, atoms, match, lo, hi,
+                             _IDENTIFIERS, format_identifier)
+
+
+# Use the optional compiled tokenizer/formatter (egglog_to_inference_core.pyx)
+# only when it is built and agrees with the pure Python versions, so a stale
+# build cannot change the output
+_tokenize = _py_tokenize
+_parse_expression = _py_parse_expression
+
+try:
+    import egglog_to_inference_core as _core
+except ImportError:
+    _core = None
+
+if _core is not None:
+    if _core_matches(_core):
+        _tokenize = _core.tokenize
+        _parse_expression = _core_parse_expression
+    else:
+        warnings.warn(
+            "egglog_to_inference_core does not match egglog_to_inference; "
+            "rebuild it with 'cythonize -i egglog_to_inference_core.pyx'. "
+            "Using the pure Python implementation.",
+            RuntimeWarning,
+        )
+        _core = None
@@ -0,0 +1,146 @@
+# cython: language_level=3
+"""
+Compiled tokenizer and expression formatter for egglog_to_inference.
+
+These mirror _py_tokenize and _py_parse_expression in egglog_to_inference
+and are picked up automatically when the extension has been built in place:
+
+    cythonize -i egglog_to_inference_core.pyx
+
+Without it, the pure Python implementations are used. The two must produce
+identical output, so any change here or there has to be made in both;
+egglog_to_inference checks this at import with _core_matches and falls back
+to the pure Python versions, with a RuntimeWarning, if they disagree.
+Indexing is left bounds-checked: a bad span raises IndexError as in the
+pure Python version rather than reading past the end of a list.
+"""
+
+from cpython.unicode cimport Py_UNICODE_ISSPACE
+
+import sys
+
+cdef enum:
+    LPAREN = 0
+    RPAREN = 1
+    ATOM = 2
+
+
+def tokenize(str text):
+    """Split an s-expression into (kinds, atoms, match) token lists."""
+    cdef list kinds = []
+    cdef list atoms = []
+    cdef list match = []
+    cdef list stack = []
+    cdef Py_ssize_t i = 0
+    cdef Py_ssize_t n = len(text)
+    cdef Py_ssize_t start, open_idx
+    cdef Py_UCS4 char
+    intern = sys.intern
+
+    while i < n:
+        char = text[i]
+        if char == u'(':
+            stack.append(len(kinds))
+            kinds.append(LPAREN)
+            atoms.append(u'(')
+            match.append(-1)
+            i += 1
+        elif char == u')':
+            if stack:
+                open_idx = stack.pop()
+                match[open_idx] = len(kinds)
+                kinds.append(RPAREN)
+                atoms.append(u')')
+                match.append(open_idx)
+            i += 1
+        elif Py_UNICODE_ISSPACE(char):
+            i += 1
+        else:
+            start = i
+            while i < n:
+                char = text[i]
+                if char == u'(' or char == u')' or Py_UNICODE_ISSPACE(char):
+                    break
+                i += 1
+            kinds.append(ATOM)
+            atoms.append(intern(text[start:i]))
+            match.append(-1)
+
+    while stack:
+        open_idx = stack.pop()
+        match[open_idx] = len(kinds)
+        kinds.append(RPAREN)
+        atoms.append(u')')
+        match.append(open_idx)
+
+    return kinds, atoms, match
+
+
+cdef list _items(list kinds, list match, Py_ssize_t lo, Py_ssize_t hi):
+    """Return the start index of each top-level item in tokens[lo:hi]."""
+    cdef list starts = []
+    cdef Py_ssize_t i = lo
+    while i < hi:
+        starts.append(i)
+        if <int>kinds[i] == LPAREN:
+            i = <Py_ssize_t>match[i] + 1
+        else:
+            i += 1
+    return starts
+
+
+def format_tree(list kinds, list atoms, list match, Py_ssize_t lo, Py_ssize_t hi,
+                dict identifiers, format_identifier):
+    """
+    Format tokens[lo:hi], using identifiers as a cache of formatted words
+    and format_identifier for words not in it yet.
+    """
+    cdef list out = []
+    cdef list work = []
+    cdef list parts
+    cdef Py_ssize_t item, k
+    cdef Py_ssize_t start
+
+    for start in reversed(_items(kinds, match, lo, hi)):
+        if work:
+            work.append(u' ')
+        work.append(start)
+
+    while work:
+        obj = work.pop()
+        if isinstance(obj, str):
+            out.append(obj)
+            continue
+
+        item = obj
+        if <int>kinds[item] == ATOM:
+            word = atoms[item]
+            formatted = identifiers.get(word)
+            if formatted is None:
+                formatted = format_identifier(word)
+            out.append(formatted)
+            continue
+
+        parts = _items(kinds, match, item + 1, match[item])
+        if not parts:
+            continue
+
+        # Children are pushed in reverse so they pop in output order
+        if len(parts) == 3 and atoms[item + 1] == u'set':
+            work.append(parts[2])
+            work.append(u' \\to ')
+            work.append(parts[1])
+        elif len(parts) == 1:
+            work.append(u')')
+            work.append(parts[0])
+            work.append(u'(')
+        else:
+            work.append(u')')
+            for k in range(len(parts) - 1, 1, -1):
+                work.append(parts[k])
+                work.append(u', ')
+            work.append(parts[1])
+            work.append(u'(')
+            work.append(parts[0])
+
+    return u''.join(out)